@@ -1,9 +1,12 @@
 #!/usr/bin/env python3
+import re
+import struct
 import traceback
 import zlib
 from base64 import b64encode
 from collections import defaultdict
 from dataclasses import dataclass
+from functools import lru_cache
 from hashlib import sha1
 from typing import Any, Dict, List, Optional, Union
 
@@ -12,23 +15,190 @@ import hyperframe.frame
 from http2 import HeaderTuple, HTTP2Converter, HTTPRequest, HTTPResponse
 from pkappa2lib import Direction, Result, Stream, StreamChunk
 
+# only memoize tiles up to this bucket size; compliant clients use a
+# fresh random key per frame, so large cached tiles would rarely be
+# reused and the cache would pin up to 256 of them for the life of the
+# converter process
+_TILED_MASK_CACHE_LIMIT = 64 * 1024
+
+
+@lru_cache(maxsize=256)
+def _tiled_mask(key_u32: int, nbytes: int) -> bytes:
+    """The 4-byte mask key repeated to cover nbytes."""
+    return (key_u32.to_bytes(4, "big") * ((nbytes + 3) // 4))[:nbytes]
+
+
+def _unmask_bignum(data: bytearray) -> None:
+    """XOR data[4:] in place with the leading 4-byte mask key.
+
+    CPython's bignum XOR works word-at-a-time instead of byte-at-a-time.
+    """
+    key_u32 = int.from_bytes(data[:4], "big")
+    n = len(data) - 4
+    # cache tiles in power-of-two buckets so frames of similar size
+    # served with the same key share an entry
+    bucket = 1 << (n - 1).bit_length()
+    if bucket <= _TILED_MASK_CACHE_LIMIT:
+        tiled = _tiled_mask(key_u32, bucket)[:n]
+    else:
+        tiled = (key_u32.to_bytes(4, "big") * ((n + 3) // 4))[:n]
+    data[4:] = (
+        int.from_bytes(data[4:], "big") ^ int.from_bytes(tiled, "big")
+    ).to_bytes(n, "big")
+
+
+# pip install numba (optional)
+# The best available unmask kernel is picked once at import time; a
+# converter can't ship a compiled extension, so numba is as native as
+# it gets here.
+try:
+    import numpy as np
+    from numba import njit
+
+    @njit(cache=True, boundscheck=False)
+    def _unmask_numba(data, key):
+        # Unrolled to a full key period per iteration so LLVM turns the
+        # body into wide SIMD XORs instead of per-byte shifts.
+        n = data.shape[0]
+        k0 = key[0]
+        k1 = key[1]
+        k2 = key[2]
+        k3 = key[3]
+        i = 0
+        while i + 8 <= n:
+            data[i] ^= k0
+            data[i + 1] ^= k1
+            data[i + 2] ^= k2
+            data[i + 3] ^= k3
+            data[i + 4] ^= k0
+            data[i + 5] ^= k1
+            data[i + 6] ^= k2
+            data[i + 7] ^= k3
+            i += 8
+        while i < n:
+            data[i] ^= key[i & 3]
+            i += 1
+
+    def _unmask_native(data: bytearray) -> None:
+        _unmask_numba(
+            np.frombuffer(data, dtype=np.uint8)[4:],
+            np.frombuffer(bytes(data[:4]), dtype=np.uint8),
+        )
+
+    _unmask = _unmask_native
+except ImportError:
+    _unmask = _unmask_bignum
+
+
+# appended to each permessage-deflate message before inflating (RFC 7692 7.2.2)
+_DEFLATE_TAIL = b"\x00\x00\xff\xff"
+
+# extended payload lengths (RFC 6455 5.2)
+_U16 = struct.Struct(">H")
+_U64 = struct.Struct(">Q")
+
+# one extension token of a Sec-WebSocket-Extensions header: the name
+# followed by its ";"-separated parameter list up to the next ","
+_EXTENSION_RE = re.compile(r"([^,;]+)((?:;[^,]*)?)")
+# one parameter: name, optionally "=" and a (quoted) value
+_PARAM_RE = re.compile(r";\s*([^;=\s][^;=]*?)\s*(?:=\s*(\"[^\"]*\"|[^;]*?)\s*)?(?=;|$)")
+
+
+@lru_cache(maxsize=4096)
+def _expected_websocket_accept(key: bytes) -> str:
+    """The Sec-WebSocket-Accept value expected for a handshake key.
+
+    Cached since replayed captures repeat the same handshake keys.
+    """
+    return b64encode(
+        sha1(key + b"258EAFA5-E914-47DA-95CA-C5AB0DC85B11").digest()
+    ).decode()
+
+
+@lru_cache(maxsize=1024)
+def _decode_websocket_extensions(
+    extensions_header: str,
+) -> Dict[str, Dict[str, Union[bool, str]]]:
+    """Parse a Sec-WebSocket-Extensions header with compiled regexes.
+
+    Cached since pcaps tend to repeat the exact same header on every
+    handshake.
+    """
+    extensions: Dict[str, Dict[str, Union[str, bool]]] = {}
+    header = extensions_header.lower()
+    for extension_match in _EXTENSION_RE.finditer(header):
+        name = extension_match.group(1).strip()
+        if not name:
+            continue
+        params: Dict[str, Union[str, bool]] = {}
+        for param_match in _PARAM_RE.finditer(extension_match.group(2)):
+            value = param_match.group(2)
+            if value is None:
+                params[param_match.group(1)] = True
+            else:
+                if value.startswith('"') and value.endswith('"'):
+                    value = value[1:-1]
+                params[param_match.group(1)] = value
+        extensions[name] = params
+    return extensions
+
 
 @dataclass
 class WebsocketFrame:
     Direction: Direction
     Header: bytearray
-    Data: bytearray
+    # bytearray while the payload still needs in-place unmasking,
+    # plain bytes otherwise
+    Data: Union[bytes, bytearray]
+
+
+class _WebsocketStreamState:
+    """All per-stream websocket state in one object.
+
+    One dict lookup per frame instead of one per state dict, and slot
+    attribute access afterwards.
+    """
+
+    __slots__ = (
+        "remaining_c2s",
+        "remaining_s2c",
+        "deflate",
+        "wbits_c2s",
+        "wbits_s2c",
+        "decompressor_c2s",
+        "decompressor_s2c",
+        "fragmented_frames",
+        "fragmented_size",
+        "is_websocket",
+        "pending_c2s",
+        "pending_s2c",
+    )
+
+    def __init__(self) -> None:
+        self.remaining_c2s = b""
+        self.remaining_s2c = b""
+        self.deflate = False
+        self.wbits_c2s = 15
+        self.wbits_s2c = 15
+        # created lazily on the first compressed message per direction
+        self.decompressor_c2s: Any = None
+        self.decompressor_s2c: Any = None
+        self.fragmented_frames: List[WebsocketFrame] = []
+        self.fragmented_size = 0
+        self.is_websocket = False
+        self.pending_c2s: List[bytes] = []
+        self.pending_s2c: List[bytes] = []
+
+    def reset_fragments(self) -> None:
+        self.fragmented_frames = []
+        self.fragmented_size = 0
 
 
 class WebsocketConverter(HTTP2Converter):
     websocket_key: Union[bytes, None]
     switched_protocols: bool
-    websocket_remaining_data: Dict[int, Dict[Direction, bytes]]
-    websocket_deflate: Dict[int, bool]
-    websocket_deflate_decompressor: Dict[int, Dict[Direction, Any]]
-    websocket_message_fragmented_frames: Dict[int, List[WebsocketFrame]]
     websocket_enable_connect_protocol: bool
-    websocket_stream: Dict[int, bool]
+    websocket_streams: Dict[int, _WebsocketStreamState]
 
     def __init__(self):
         super().__init__()
@@ -43,12 +213,12 @@ class WebsocketConverter(HTTP2Converter):
         if frame.Header[1] & 0x80 == 0:
             return frame
 
-        unmasked = [
-            frame.Data[4 + i] ^ frame.Data[i % 4] for i in range(len(frame.Data) - 4)
-        ]
-        # remove mask bit
+        data = frame.Data
+        _unmask(data)
+        # drop the mask key and remove the mask bit
+        del data[:4]
         frame.Header[1] = frame.Header[1] & 0x7F
-        return WebsocketFrame(frame.Direction, frame.Header, bytearray(unmasked))
+        return frame
 
     def handle_websocket_permessage_deflate(
         self, stream_id: int, frame: WebsocketFrame
@@ -58,49 +228,61 @@ class WebsocketConverter(HTTP2Converter):
         if opcode & 0x08 != 0:
             return frame
 
+        state = self.websocket_streams[stream_id]
         # handle fragmented messages
         if frame.Header[0] & 0x80 == 0:  # FIN bit not set
-            self.websocket_message_fragmented_frames[stream_id].append(frame)
-            if len(self.websocket_message_fragmented_frames[stream_id]) > 1 and opcode != 0:
-                del self.websocket_message_fragmented_frames[stream_id]
+            state.fragmented_frames.append(frame)
+            state.fragmented_size += len(frame.Data)
+            if len(state.fragmented_frames) > 1 and opcode != 0:
+                state.reset_fragments()
                 raise Exception("Invalid fragmented message")
-            if len(self.websocket_message_fragmented_frames[stream_id]) > 50:  # arbitrary limit
-                del self.websocket_message_fragmented_frames[stream_id]
+            if len(state.fragmented_frames) > 50:  # arbitrary limit
+                state.reset_fragments()
+                raise Exception("Fragmented message too long")
+            if state.fragmented_size > 16 * 1024 * 1024:  # arbitrary limit
+                state.reset_fragments()
                 raise Exception("Fragmented message too long")
             return None
 
-        if len(self.websocket_message_fragmented_frames[stream_id]) > 0:
+        if len(state.fragmented_frames) > 0:
             if opcode != 0:
-                del self.websocket_message_fragmented_frames[stream_id]
+                state.reset_fragments()
                 raise Exception("Invalid fragmented message")
             # this is the last frame of a fragmented message
-            self.websocket_message_fragmented_frames[stream_id].append(frame)
+            state.fragmented_frames.append(frame)
+            # reassemble into a buffer preallocated at the known total size
+            data = bytearray(state.fragmented_size + len(frame.Data))
+            write_pos = 0
+            for f in state.fragmented_frames:
+                data[write_pos : write_pos + len(f.Data)] = f.Data
+                write_pos += len(f.Data)
             frame = WebsocketFrame(
                 Direction=frame.Direction,
-                Header=self.websocket_message_fragmented_frames[stream_id][0].Header,
-                Data=bytearray(
-                    b"".join(
-                        [
-                            f.Data
-                            for f in self.websocket_message_fragmented_frames[stream_id]
-                        ]
-                    )
-                ),
+                Header=state.fragmented_frames[0].Header,
+                Data=data,
             )
             frame.Header[0] |= 0x80  # set FIN bit
             # datalength in the header is wrong now, but we don't care
-            del self.websocket_message_fragmented_frames[stream_id]
+            state.reset_fragments()
 
         # only the first frame of a fragmented message has the RSV1 bit set
         if frame.Header[0] & 0x40 == 0:  # RSV1 "Per-Message Compressed" bit not set
             return frame
 
-        data = frame.Data + b"\x00\x00\xff\xff"
-        data = self.websocket_deflate_decompressor[stream_id][
-            frame.Direction
-        ].decompress(data)
+        data = frame.Data + _DEFLATE_TAIL
+        if frame.Direction == Direction.CLIENTTOSERVER:
+            decompressor = state.decompressor_c2s
+            if decompressor is None:
+                decompressor = zlib.decompressobj(wbits=-state.wbits_c2s)
+                state.decompressor_c2s = decompressor
+        else:
+            decompressor = state.decompressor_s2c
+            if decompressor is None:
+                decompressor = zlib.decompressobj(wbits=-state.wbits_s2c)
+                state.decompressor_s2c = decompressor
+        data = decompressor.decompress(data)
         frame.Header[0] = frame.Header[0] & 0xBF  # remove RSV1 bit
-        return WebsocketFrame(frame.Direction, frame.Header, bytearray(data))
+        return WebsocketFrame(frame.Direction, frame.Header, data)
 
     def handle_websocket_frame(self, frame: WebsocketFrame) -> WebsocketFrame:
         """
@@ -120,64 +302,84 @@ class WebsocketConverter(HTTP2Converter):
         self, direction: Direction, stream_id: int, content: bytes
     ) -> bytes:
         try:
-            frames: List[bytes] = []
-            frame = bytearray(
-                self.websocket_remaining_data[stream_id][direction] + content
-            )
-            del self.websocket_remaining_data[stream_id][direction]
-            while len(frame) > 1:
+            out = bytearray()
+            state = self.websocket_streams[stream_id]
+            buf: bytes
+            if direction == Direction.CLIENTTOSERVER:
+                buf = state.remaining_c2s + content
+                state.remaining_c2s = b""
+            else:
+                buf = state.remaining_s2c + content
+                state.remaining_s2c = b""
+            # per-iteration lookups hoisted out of the loop; none of
+            # these can change while a chunk is being parsed
+            client_to_server = direction == Direction.CLIENTTOSERVER
+            deflate = state.deflate
+            unmask_frame = self.unmask_websocket_frames
+            inflate_frame = self.handle_websocket_permessage_deflate
+            handle_frame = self.handle_websocket_frame
+            pos: int = 0
+            while len(buf) - pos > 1:
                 try:
-                    data_length = frame[1] & 0x7F
-                    mask_offset = 2
-                    if data_length == 126:
-                        mask_offset = 4
-                    elif data_length == 127:
-                        mask_offset = 10
-
-                    if len(frame) < mask_offset:
+                    data_length: int = buf[pos + 1] & 0x7F
+                    extended: int = 2 * (data_length == 126) + 8 * (data_length == 127)
+                    mask_offset: int = 2 + extended
+
+                    if len(buf) - pos < mask_offset:
                         raise IndexError("Not enough data for a full frame")
-                    if mask_offset > 2:
-                        data_length = int.from_bytes(
-                            frame[2:mask_offset], byteorder="big"
-                        )
+                    if extended == 2:
+                        data_length = _U16.unpack_from(buf, pos + 2)[0]
+                    elif extended == 8:
+                        data_length = _U64.unpack_from(buf, pos + 2)[0]
 
-                    data_offset = mask_offset
+                    data_offset: int = mask_offset
                     # frame masked?
-                    if frame[1] & 0x80 != 0:
+                    if buf[pos + 1] & 0x80 != 0:
                         data_offset += 4
 
-                    if len(frame) < data_offset + data_length:
+                    if len(buf) - pos < data_offset + data_length:
                         raise IndexError("Not enough data for a full frame")
 
+                    data = buf[pos + mask_offset : pos + data_offset + data_length]
                     websocket_frame = WebsocketFrame(
                         Direction=direction,
-                        Header=frame[:mask_offset],
-                        Data=frame[mask_offset : data_offset + data_length],
+                        Header=bytearray(buf[pos : pos + mask_offset]),
+                        # only masked payloads get mutated in place
+                        Data=bytearray(data) if data_offset > mask_offset else data,
                     )
-                    websocket_frame = self.unmask_websocket_frames(websocket_frame)
-                    if self.websocket_deflate[stream_id]:
-                        deflated_websocket_frame = self.handle_websocket_permessage_deflate(
+                    # servers must not mask their frames (RFC 6455 5.1),
+                    # so don't even look at the mask bit for them
+                    if client_to_server:
+                        websocket_frame = unmask_frame(websocket_frame)
+                    if deflate:
+                        deflated_websocket_frame = inflate_frame(
                             stream_id, websocket_frame
                         )
                         if deflated_websocket_frame is None:
-                            break
+                            # frame got absorbed into a fragmented
+                            # message; it is consumed, move on
+                            pos += data_offset + data_length
+                            continue
                         websocket_frame = deflated_websocket_frame
-                    websocket_frame = self.handle_websocket_frame(websocket_frame)
+                    websocket_frame = handle_frame(websocket_frame)
 
-                    frames.append(websocket_frame.Header + bytes(websocket_frame.Data))
-                    frame = frame[data_offset + data_length :]
+                    out += websocket_frame.Header
+                    out += websocket_frame.Data
+                    pos += data_offset + data_length
                 except IndexError:
                     # not enough data for a full frame
                     break
-            if len(frame) > 0:
+            if pos < len(buf):
                 # TODO: For http/2 the last chunk doesn't necessarily have to contain
                 #       data for a websocket frame, so remaining data could be silently
                 #       hidden. This is a general problem with truncated http/2 traffic.
                 if self.is_last_chunk:
-                    frames.append(frame)
+                    out += buf[pos:]
+                elif direction == Direction.CLIENTTOSERVER:
+                    state.remaining_c2s = buf[pos:]
                 else:
-                    self.websocket_remaining_data[stream_id][direction] = frame
-            return b"".join(frames)
+                    state.remaining_s2c = buf[pos:]
+            return bytes(out)
         except Exception as ex:
             self.log(f"Error while handling websocket frame: {ex}")
             self.log(traceback.format_exc())
@@ -187,48 +389,33 @@ class WebsocketConverter(HTTP2Converter):
     def handle_permessage_deflate_extension(
         self, stream_id: int, websocket_deflate_parameters: Dict[str, Union[bool, str]]
     ) -> None:
-        self.websocket_deflate[stream_id] = True
-        self.websocket_message_fragmented_frames[stream_id] = []
+        state = self.websocket_streams[stream_id]
+        state.deflate = True
+        state.reset_fragments()
         window_bits = 15
         if "server_max_window_bits" in websocket_deflate_parameters:
             window_bits = int(websocket_deflate_parameters["server_max_window_bits"])
-        self.websocket_deflate_decompressor[stream_id][Direction.SERVERTOCLIENT] = (
-            zlib.decompressobj(wbits=-window_bits)
-        )
+        state.wbits_s2c = window_bits
+        state.decompressor_s2c = None
         window_bits = 15
         if "client_max_window_bits" in websocket_deflate_parameters:
             window_bits = int(websocket_deflate_parameters["client_max_window_bits"])
-        self.websocket_deflate_decompressor[stream_id][Direction.CLIENTTOSERVER] = (
-            zlib.decompressobj(wbits=-window_bits)
-        )
+        state.wbits_c2s = window_bits
+        state.decompressor_c2s = None
 
     def decode_websocket_extensions(
         self, extensions_header: str
     ) -> Dict[str, Dict[str, Union[bool, str]]]:
-        extensions: Dict[str, Dict[str, Union[str, bool]]] = {}
-        if extensions_header:
-            raw_extensions = map(
-                lambda s: s.strip().lower(), extensions_header.split(",")
-            )
-            for extension in raw_extensions:
-                extension, raw_params = (
-                    extension.split(";", 1) if ";" in extension else (extension, "")
-                )
-                params: Dict[str, Union[str, bool]] = {}
-                reduced_raw_params = filter(
-                    lambda p: len(p) != 0,
-                    map(lambda p: p.strip(), raw_params.split(";")),
-                )
-                for param in reduced_raw_params:
-                    param_and_value = param.split("=", 1)
-                    if len(param_and_value) == 1:
-                        params[param_and_value[0]] = True
-                    else:
-                        if param_and_value[1].startswith('"') and param_and_value[1].endswith('"'):
-                            param_and_value[1] = param_and_value[1][1:-1]
-                        params[param_and_value[0]] = param_and_value[1]
-                extensions[extension] = params
-        return extensions
+        if not extensions_header:
+            return {}
+        # copy the cached value so callers (including subclasses) can
+        # mutate the result without corrupting it for later streams
+        return {
+            name: dict(params)
+            for name, params in _decode_websocket_extensions(
+                extensions_header
+            ).items()
+        }
 
     def handle_http2_headers(
         self,
@@ -278,7 +465,7 @@ class WebsocketConverter(HTTP2Converter):
                 self.log(f"Unsupported extensions: {extensions}")
 
         # Switch this stream to websocket mode
-        self.websocket_stream[frame.stream_id] = True
+        self.websocket_streams[frame.stream_id].is_websocket = True
 
     def handle_http2_event(
         self, direction: Direction, frame: hyperframe.frame.Frame
@@ -293,26 +480,93 @@ class WebsocketConverter(HTTP2Converter):
             # The client can use the extended CONNECT protocol
             # using the ":protocol" pseudo header.
             self.websocket_enable_connect_protocol = True
-        elif isinstance(frame, hyperframe.frame.DataFrame):
-            if not self.websocket_stream[frame.stream_id]:
-                return super().handle_http2_event(direction, frame)
+        return super().handle_http2_event(direction, frame)
 
-            return self.handle_websocket_frames(direction, frame.stream_id, frame.data)
+    def _flush_websocket_data(
+        self, chunk: StreamChunk, direction: Direction
+    ) -> List[StreamChunk]:
+        """Drain the DataFrame payloads queued for each websocket stream
+        with one handle_websocket_frames call per stream."""
+        chunks: List[StreamChunk] = []
+        for stream_id, state in self.websocket_streams.items():
+            pending = (
+                state.pending_c2s
+                if direction == Direction.CLIENTTOSERVER
+                else state.pending_s2c
+            )
+            if not pending:
+                continue
+            data = pending[0] if len(pending) == 1 else b"".join(pending)
+            pending.clear()
+            chunks.append(
+                chunk.derive(
+                    content=self.handle_websocket_frames(direction, stream_id, data)
+                    + b"\n",
+                )
+            )
+        return chunks
+
+    def handle_http2_request(self, chunk: StreamChunk) -> List[StreamChunk]:
+        if not self.h2_server_buffer:
+            return [chunk]
+        self.h2_server_buffer.add_data(chunk.Content)
+        events = []
+        for event in self.h2_server_buffer:
+            if isinstance(event, hyperframe.frame.DataFrame):
+                state = self.websocket_streams[event.stream_id]
+                if state.is_websocket:
+                    state.pending_c2s.append(event.data)
+                    continue
+            events.append(
+                chunk.derive(
+                    content=self.handle_http2_event(Direction.CLIENTTOSERVER, event)
+                    + b"\n",
+                )
+            )
+        events.extend(self._flush_websocket_data(chunk, Direction.CLIENTTOSERVER))
+        return events
+
+    def handle_http2_response(self, chunk: StreamChunk) -> List[StreamChunk]:
+        if not self.h2_client_buffer:
+            return [chunk]
+        self.h2_active = True
+        self.h2_client_buffer.add_data(chunk.Content)
+        events = []
+        for event in self.h2_client_buffer:
+            if isinstance(event, hyperframe.frame.DataFrame):
+                state = self.websocket_streams[event.stream_id]
+                if state.is_websocket:
+                    state.pending_s2c.append(event.data)
+                    continue
+            events.append(
+                chunk.derive(
+                    content=self.handle_http2_event(Direction.SERVERTOCLIENT, event)
+                    + b"\n",
+                )
+            )
+        events.extend(self._flush_websocket_data(chunk, Direction.SERVERTOCLIENT))
+        return events
 
-        return super().handle_http2_event(direction, frame)
+    def _handle_websocket_chunk(
+        self, chunk: StreamChunk
+    ) -> Optional[List[StreamChunk]]:
+        # bound to handle_raw_client_chunk/handle_raw_server_chunk once
+        # the protocols switched; every later chunk is websocket data
+        try:
+            return [
+                chunk.derive(
+                    content=self.handle_websocket_frames(
+                        chunk.Direction, 0, chunk.Content
+                    ),
+                )
+            ]
+        except Exception as ex:
+            return [chunk.derive(content=str(ex).encode())]
 
     def handle_raw_client_chunk(
         self, chunk: StreamChunk
     ) -> Optional[List[StreamChunk]]:
         try:
-            if self.switched_protocols:
-                return [
-                    chunk.derive(
-                        content=self.handle_websocket_frames(
-                            chunk.Direction, 0, chunk.Content
-                        ),
-                    )
-                ]
             return super().handle_raw_client_chunk(chunk)
         except Exception as ex:
             return [chunk.derive(content=str(ex).encode())]
@@ -321,14 +575,6 @@ class WebsocketConverter(HTTP2Converter):
         self, chunk: StreamChunk
     ) -> Optional[List[StreamChunk]]:
         try:
-            if self.switched_protocols:
-                return [
-                    chunk.derive(
-                        content=self.handle_websocket_frames(
-                            chunk.Direction, 0, chunk.Content
-                        ),
-                    )
-                ]
             return super().handle_raw_server_chunk(chunk)
         except Exception as ex:
             return [chunk.derive(content=str(ex).encode())]
@@ -368,16 +614,16 @@ class WebsocketConverter(HTTP2Converter):
             ):
                 if not self.websocket_key:
                     raise Exception("No websocket key found")
-                expected_accept = b64encode(
-                    sha1(
-                        self.websocket_key + b"258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
-                    ).digest()
-                ).decode()
+                expected_accept = _expected_websocket_accept(self.websocket_key)
                 if response.headers.get("Sec-WebSocket-Accept") != expected_accept:
                     raise Exception(
                         f"Invalid websocket key: {response.headers.get('Sec-WebSocket-Accept')} != {expected_accept}"
                     )
                 self.switched_protocols = True
+                # every chunk from here on carries websocket frames;
+                # dispatch straight to the websocket handler
+                self.handle_raw_client_chunk = self._handle_websocket_chunk
+                self.handle_raw_server_chunk = self._handle_websocket_chunk
 
                 # Decode extensions header
                 # Sec-WebSocket-Extensions: extension-name; param1=value1; param2="value2", extension-name2; param1, extension-name3, extension-name4; param1=value1
@@ -408,17 +654,15 @@ class WebsocketConverter(HTTP2Converter):
         # http1
         self.websocket_key = None
         self.switched_protocols = False
+        # undo the websocket fast-path rebinding of a previous stream
+        self.__dict__.pop("handle_raw_client_chunk", None)
+        self.__dict__.pop("handle_raw_server_chunk", None)
 
         # http2
         self.websocket_enable_connect_protocol = False
-        self.websocket_stream = defaultdict(bool)
-
-        # deflate extension
-        self.websocket_deflate = defaultdict(bool)
-        self.websocket_deflate_decompressor = defaultdict(dict)
-        self.websocket_message_fragmented_frames = defaultdict(list)
 
-        self.websocket_remaining_data = defaultdict(lambda: defaultdict(bytes))
+        # per-stream state (framing, deflate extension)
+        self.websocket_streams = defaultdict(_WebsocketStreamState)
         return super().handle_stream(stream)
 
 